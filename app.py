@@ -1,9 +1,27 @@
+import asyncio
 import sqlite3
 import streamlit as st
-from memoir_rag import search_across_chunks
+from memoir_rag import initialize_db, search_across_chunks
 
-def load_memoir_from_db(conn, memoir_id):
-    cursor = conn.cursor()
+@st.cache_resource
+def get_conn():
+    # Bring the schema and FTS index up to date before serving questions
+    initialize_db('memoirs.db').close()
+
+    # One connection per process, reused across Streamlit reruns
+    conn = sqlite3.connect('memoirs.db', check_same_thread=False, isolation_level=None)
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-64000;
+    ''')
+    return conn
+
+@st.cache_data(ttl=3600)
+def load_memoir_from_db(_conn, memoir_id):
+    cursor = _conn.cursor()
     cursor.execute('''
         SELECT memoirs.author, memoir_chunks.content, memoir_chunks.image_path
         FROM memoirs
@@ -23,11 +41,11 @@ def display_memoir_content(memoir_data):
         st.write(chunk)
 
 def handle_user_question(conn, user_input, memoir_id, author):
-    return search_across_chunks(conn, user_input, memoir_id, author)
+    return asyncio.run(search_across_chunks(conn, user_input, memoir_id, author))
 
 def main():
     st.title("Alan's Memoir: Interactive Q&A")
-    conn = sqlite3.connect('memoirs.db')
+    conn = get_conn()
     memoir_id = 1 # Modify per the memoir ID you want to interact with
     memoir_data = load_memoir_from_db(conn, memoir_id)
     display_memoir_content(memoir_data)
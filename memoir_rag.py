@@ -10,19 +10,26 @@ text-to-image model, and the image path is saved in the database.
 Generated images are stored in the 'gen_image' folder.
 
 During the QA session, user questions are checked for malicious content 
-and processed for keyword extraction, enabling full-text search and 
-returning the best match from the memoir.
+and reduced to keywords, enabling full-text search and returning the 
+best match from the memoir.
 '''
 
 import warnings
 import logging
+import asyncio
+import collections
+import hashlib
+import itertools
 import os
+import tempfile
 import groq
 import sqlite3
 import argparse
 import re
+import mmap
 from monsterapi import client
 import requests
+import numpy as np
 
 ################################################################################
 # LLM setup
@@ -32,10 +39,35 @@ groq_client = groq.Groq(
     api_key=os.environ.get("GROQ_API_KEY"),
 )
 
+# LLM responses are cached per process, keyed by a hash of the request, so
+# repeated questions (e.g. on every Streamlit rerun) skip the Groq round trip
+LLM_CACHE_SIZE = 512
+_llm_cache = collections.OrderedDict()
+
+def _cache_key(*parts):
+    return hashlib.blake2b('\0'.join(map(str, parts)).encode('utf-8'), digest_size=16).digest()
+
+def _cache_get(key):
+    try:
+        _llm_cache.move_to_end(key)
+        return _llm_cache[key]
+    except KeyError:
+        return None
+
+def _cache_put(key, value):
+    _llm_cache[key] = value
+    if len(_llm_cache) > LLM_CACHE_SIZE:
+        _llm_cache.popitem(last=False)
+
 def run_llm(system, user, model='llama3-8b-8192', seed=None):
     '''
     Helper function to interact with the LLM using the Groq API.
     '''
+    key = _cache_key(system, user, model, seed)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
     chat_completion = groq_client.chat.completions.create(
         messages=[
             {
@@ -50,16 +82,207 @@ def run_llm(system, user, model='llama3-8b-8192', seed=None):
         model=model,
         seed=seed,
     )
-    return chat_completion.choices[0].message.content
+    response = chat_completion.choices[0].message.content
+    _cache_put(key, response)
+    return response
+
+################################################################################
+# Reranker setup
+################################################################################
+
+# Optional cross-encoder reranking of FTS candidates, enabled with
+# MEMOIR_RERANK=1. Requires the flashrank package (quantized ONNX, CPU only).
+reranker = None
+if os.environ.get("MEMOIR_RERANK") == "1":
+    try:
+        from flashrank import Ranker, RerankRequest
+        reranker = Ranker(model_name="ms-marco-MiniLM-L-12-v2")
+    except Exception as e:
+        logging.error("Reranker unavailable, using BM25 order: %s", e)
+
+def rerank_chunks(user_input, chunks):
+    '''
+    Reorders candidate chunks by cross-encoder relevance to the question.
+    Keeps the BM25 order if reranking is disabled or fails.
+    '''
+    if reranker is None or len(chunks) < 2:
+        return chunks
+    passages = [{'id': i, 'text': chunk} for i, chunk in enumerate(chunks)]
+    try:
+        reranked = reranker.rerank(RerankRequest(query=user_input, passages=passages))
+    except Exception:
+        return chunks
+    return [passage['text'] for passage in reranked]
+
+################################################################################
+# Embedding setup
+################################################################################
+
+# Optional dense retrieval. When sentence-transformers is installed, chunks
+# are embedded at ingest and dense matches are fused with BM25 at query time.
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+embedder = None
+
+def embed_texts(texts):
+    '''
+    Returns unit-length float32 embeddings of the texts, one row per text,
+    or None if sentence-transformers is not installed.
+    '''
+    global embedder
+    if SentenceTransformer is None:
+        return None
+    if embedder is None:
+        embedder = SentenceTransformer(EMBEDDING_MODEL, device='cpu')
+    embeddings = embedder.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True)
+    return embeddings.astype(np.float32)
+
+def rrf_fuse(*rankings, k=60):
+    '''
+    Merges ranked lists of chunk ids with Reciprocal Rank Fusion: each id
+    scores the sum of 1 / (k + rank) over the lists it appears in.
+    '''
+    scores = collections.defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] += 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
 
 ################################################################################
 # Database functions
 ################################################################################
 
+# Chapter titles and LLM keywords are indexed next to the content so they
+# can be weighted separately. Porter stemming lets "swimming" match chunks
+# that only say "swim".
+FTS_SCHEMA = '''CREATE VIRTUAL TABLE memoir_chunks_fts
+        USING fts5(title, keywords, content, content='memoir_chunks', content_rowid='id',
+                   tokenize='porter unicode61 remove_diacritics 2')'''
+
+FTS_TRIGGERS = {
+    'memoir_chunks_ai': '''
+        CREATE TRIGGER memoir_chunks_ai AFTER INSERT ON memoir_chunks BEGIN
+            INSERT INTO memoir_chunks_fts (rowid, title, keywords, content)
+            VALUES (new.id, new.title, new.keywords, new.content);
+        END
+    ''',
+    'memoir_chunks_ad': '''
+        CREATE TRIGGER memoir_chunks_ad AFTER DELETE ON memoir_chunks BEGIN
+            INSERT INTO memoir_chunks_fts (memoir_chunks_fts, rowid, title, keywords, content)
+            VALUES ('delete', old.id, old.title, old.keywords, old.content);
+        END
+    ''',
+    'memoir_chunks_au': '''
+        CREATE TRIGGER memoir_chunks_au
+        AFTER UPDATE OF title, keywords, content ON memoir_chunks BEGIN
+            INSERT INTO memoir_chunks_fts (memoir_chunks_fts, rowid, title, keywords, content)
+            VALUES ('delete', old.id, old.title, old.keywords, old.content);
+            INSERT INTO memoir_chunks_fts (rowid, title, keywords, content)
+            VALUES (new.id, new.title, new.keywords, new.content);
+        END
+    ''',
+}
+
+def backfill_titles(cursor):
+    """
+    Sets the title of every chunk from its "Chapter X - Title" heading line,
+    using the same rule as chapter_title for newly saved chunks.
+    """
+    # An FTS table that is missing or outdated cannot take the update
+    # trigger's writes; initialize_db rebuilds it (reindexing every chunk)
+    # and recreates the trigger after migrating
+    cursor.execute('''
+        SELECT sql FROM sqlite_master WHERE name = 'memoir_chunks_fts'
+    ''')
+    row = cursor.fetchone()
+    if row is None or row[0] != FTS_SCHEMA:
+        cursor.execute('DROP TRIGGER IF EXISTS memoir_chunks_au')
+
+    cursor.execute('''
+        SELECT id, content, title FROM memoir_chunks
+    ''')
+    titles = [(chapter_title(content), chunk_id, title)
+              for chunk_id, content, title in cursor.fetchall()]
+    cursor.executemany('''
+        UPDATE memoir_chunks SET title = ? WHERE id = ?
+    ''', [(new_title, chunk_id) for new_title, chunk_id, title in titles if new_title != title])
+
+# Schema changes to memoir_chunks since its first release, applied once per
+# database in version order and recorded in schema_migrations. Each step is
+# a SQL statement or a function taking a cursor. Columns a database already
+# has (e.g. from a newer CREATE TABLE) are skipped.
+MIGRATIONS = {
+    2: [
+        'ALTER TABLE memoir_chunks ADD COLUMN system_prompt TEXT',
+        'ALTER TABLE memoir_chunks ADD COLUMN image_path TEXT',
+    ],
+    3: [
+        'ALTER TABLE memoir_chunks ADD COLUMN title TEXT',
+        'ALTER TABLE memoir_chunks ADD COLUMN keywords TEXT',
+    ],
+    # Only reindex a chunk when one of its indexed columns changes
+    4: [
+        'DROP TRIGGER IF EXISTS memoir_chunks_au',
+        FTS_TRIGGERS['memoir_chunks_au'],
+    ],
+    # float32 chunk embeddings for dense retrieval
+    5: [
+        'ALTER TABLE memoir_chunks ADD COLUMN embedding BLOB',
+    ],
+    # (Re)derive titles of existing chunks with chapter_title
+    6: [
+        backfill_titles,
+    ],
+}
+
+def migrate_db(conn):
+    """
+    Applies the schema migrations the database has not recorded yet.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY
+        )
+    ''')
+    cursor.execute('SELECT MAX(version) FROM schema_migrations')
+    current_version = cursor.fetchone()[0] or 1
+    pending = [version for version in sorted(MIGRATIONS) if version > current_version]
+    if not pending:
+        return
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        for version in pending:
+            for statement in MIGRATIONS[version]:
+                if callable(statement):
+                    statement(cursor)
+                    continue
+                try:
+                    cursor.execute(statement)
+                except sqlite3.OperationalError as e:
+                    if 'duplicate column name' not in str(e):
+                        raise
+            cursor.execute('''
+                INSERT INTO schema_migrations (version) VALUES (?)
+            ''', (version,))
+    except BaseException:
+        # Release the write lock so the failure is not masked by "database is locked"
+        conn.rollback()
+        raise
+    conn.commit()
+
 def initialize_db(db_path='memoirs.db'):
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
+    # WAL lets readers keep querying while a memoir is being saved
+    cursor.execute('PRAGMA journal_mode=WAL')
+
     # Create memoirs table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS memoirs (
@@ -74,100 +297,143 @@ def initialize_db(db_path='memoirs.db'):
         CREATE TABLE IF NOT EXISTS memoir_chunks (
             id INTEGER PRIMARY KEY,
             memoir_id INTEGER,
+            title TEXT,
+            keywords TEXT,
             content TEXT,
             system_prompt TEXT,
+            image_path TEXT,
+            embedding BLOB,
             FOREIGN KEY (memoir_id) REFERENCES memoirs (id)
         )
     ''')
 
-    # Create an FTS table for fast full-text search
-    cursor.execute('''
-        CREATE VIRTUAL TABLE IF NOT EXISTS memoir_chunks_fts
-        USING fts5(content, chunk_id UNINDEXED, memoir_id UNINDEXED)
-    ''')
+    # Bring older databases up to date; the FTS table indexes the title and
+    # keywords columns, so they must exist before it is (re)built
+    migrate_db(conn)
 
-    conn.commit()
-    return conn
-
-def add_system_prompt_column(conn):
-    """
-    Ensures the system_prompt column exists in memoir_chunks.
-    """
-    cursor = conn.cursor()
+    # Create an external-content FTS table for fast full-text search. The
+    # FTS rowid is the memoir_chunks id, so no text is stored twice. Older
+    # databases with a different FTS definition are rebuilt in place.
     cursor.execute('''
-        PRAGMA table_info(memoir_chunks);
+        SELECT sql FROM sqlite_master WHERE name = 'memoir_chunks_fts'
     ''')
-    columns = [row[1] for row in cursor.fetchall()]
-    if 'system_prompt' not in columns:
+    row = cursor.fetchone()
+    if row is None or row[0] != FTS_SCHEMA:
+        cursor.execute('DROP TABLE IF EXISTS memoir_chunks_fts')
+        cursor.execute(FTS_SCHEMA)
         cursor.execute('''
-            ALTER TABLE memoir_chunks ADD COLUMN system_prompt TEXT
+            INSERT INTO memoir_chunks_fts (memoir_chunks_fts) VALUES ('rebuild')
         ''')
-        conn.commit()
 
-def add_image_path_column(conn):
-    """
-    Adds column for generated image path in memoir_chunks.
-    """
-    cursor = conn.cursor()
-    cursor.execute('''
-        PRAGMA table_info(memoir_chunks);
-    ''')
-    columns = [row[1] for row in cursor.fetchall()]
-    if 'image_path' not in columns:
-        cursor.execute('''
-            ALTER TABLE memoir_chunks ADD COLUMN image_path TEXT
-        ''')
-        conn.commit()
+        # Keep the FTS index in sync with memoir_chunks
+        for trigger in FTS_TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            cursor.execute(FTS_TRIGGERS[trigger])
+
+    conn.commit()
+    return conn
+
+# Number of chapters inserted and illustrated per transaction while saving
+SAVE_BATCH_SIZE = 256
 
 def save_memoir_to_db(conn, title, author, content):
     """
     Saves a memoir and its metadata to the database.
+    `content` is either the memoir text or an iterable of its chapters,
+    such as the generator returned by load_memoir. Chapters are consumed
+    in batches, so only one batch is held in memory at a time.
     """
     cursor = conn.cursor()
-    
+
     # Insert memoir metadata
+    cursor.execute('BEGIN IMMEDIATE')
     cursor.execute('''
         INSERT INTO memoirs (title, author)
         VALUES (?, ?)
     ''', (title, author))
     memoir_id = cursor.lastrowid
+    conn.commit()
 
-    # Chunk the memoir content by chapters
-    chapters = chunk_by_chapter(content)
-    for chapter in chapters:
+    # Chunk the memoir content unless it is already chunked. If any batch
+    # fails, remove the memoir and the chunks saved so far, so a retry
+    # starts from a clean slate instead of leaving a partial memoir behind.
+    chapters = iter_chunks(content) if isinstance(content, str) else iter(content)
+    try:
+        while batch := list(itertools.islice(chapters, SAVE_BATCH_SIZE)):
+            save_chapters_to_db(conn, memoir_id, author, batch)
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        cursor.execute('BEGIN IMMEDIATE')
         cursor.execute('''
-            INSERT INTO memoir_chunks (memoir_id, content)
-            VALUES (?, ?)
-        ''', (memoir_id, chapter))
-        chunk_id = cursor.lastrowid
-
-        # Add to FTS table
+            DELETE FROM memoir_chunks WHERE memoir_id = ?
+        ''', (memoir_id,))
         cursor.execute('''
-            INSERT INTO memoir_chunks_fts (content, chunk_id, memoir_id)
-            VALUES (?, ?, ?)
-        ''', (chapter, chunk_id, memoir_id))
+            DELETE FROM memoirs WHERE id = ?
+        ''', (memoir_id,))
+        conn.commit()
+        raise
 
-        # Generate a system prompt for the chapter
-        system_prompt = generate_system_prompt(author, chapter)
+    print(f"Memoir '{title}' by {author} saved with chunks, prompts, and images.")
 
-        # Update the system_prompt column in memoir_chunks
-        cursor.execute('''
-            UPDATE memoir_chunks
-            SET system_prompt = ?
-            WHERE id = ?
-        ''', (system_prompt, chunk_id))
-
-        # Generate an image for the chapter
-        image_path = generate_image(system_prompt)
-        if image_path:
-            cursor.execute('''
-                UPDATE memoir_chunks
-                SET image_path = ?
-                WHERE id = ?
-            ''', (image_path, chunk_id))
+def save_chapters_to_db(conn, memoir_id, author, chapters):
+    """
+    Saves a batch of chapters of a memoir with their prompts and images.
+    """
+    cursor = conn.cursor()
+
+    # Generate keywords, a system prompt and an image for every chapter
+    # concurrently, before opening a transaction so readers and writers are
+    # not blocked during the network calls
+    media = asyncio.run(generate_chapter_media(author, chapters))
 
+    # Embed the chapters for dense retrieval, if available
+    embeddings = embed_texts(chapters)
+    if embeddings is None:
+        embeddings = [None] * len(chapters)
+    else:
+        embeddings = [embedding.tobytes() for embedding in embeddings]
+
+    # Insert the chapters with everything generated for them in a single
+    # write transaction; the FTS trigger indexes each chunk exactly once
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.executemany('''
+        INSERT INTO memoir_chunks
+            (memoir_id, title, keywords, content, system_prompt, image_path, embedding)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(memoir_id, chapter_title(chapter), keywords, chapter, system_prompt, image_path, embedding)
+          for chapter, (keywords, system_prompt, image_path), embedding
+          in zip(chapters, media, embeddings)])
     conn.commit()
-    print(f"Memoir '{title}' by {author} saved with chunks, prompts, and images.")
+
+def backfill_keywords(conn, concurrency=8):
+    """
+    Generates keywords for chunks saved before keywords were indexed, one
+    batch at a time. Updating a chunk's keywords reindexes it through the
+    FTS update trigger. Chunks whose generation fails are left NULL.
+    """
+    cursor = conn.cursor()
+    last_id = 0
+    while True:
+        cursor.execute('''
+            SELECT id, content FROM memoir_chunks
+            WHERE keywords IS NULL AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, SAVE_BATCH_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        keywords = asyncio.run(generate_keywords_for(
+            [content for _, content in rows], concurrency))
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.executemany('''
+            UPDATE memoir_chunks SET keywords = ? WHERE id = ?
+        ''', [(chunk_keywords, chunk_id)
+              for (chunk_id, _), chunk_keywords in zip(rows, keywords) if chunk_keywords])
+        conn.commit()
 
 def load_memoir_from_db(conn, author):
     '''
@@ -184,112 +450,299 @@ def load_memoir_from_db(conn, author):
 # Memoir functions
 ################################################################################
 
+# Chapter headings like "Chapter 5 - Jones Beach Undertow !!!" start a line;
+# a chapter runs until the next heading. Anchored and linear, so there is no
+# backtracking over the whole memoir. Matches bytes so it can scan an mmap.
+_CHAPTER_RE = re.compile(
+    rb"^(?:\xef\xbb\xbf)?(Chapter \d+ - [^\n]*(?:\n(?!Chapter \d+ - ).*)*)",
+    re.MULTILINE,
+)
+
+def _decode_chapter(raw):
+    '''
+    Decodes a matched chapter, normalizing Windows line endings.
+    '''
+    return raw.decode('utf-8').replace('\r\n', '\n').rstrip('\r')
+
+# Sentence boundaries for semantic chunking; the whitespace is captured so
+# chunks keep the memoir's original spacing and paragraphs
+_SENTENCE_RE = re.compile(r'(?<=[.!?])(\s+)')
+
 def load_memoir(file_path):
     '''
-    Load the memoir from a text file.
+    Lazily yields the chunks of a memoir text file. The file is memory
+    mapped, so for chaptered memoirs only the chapter being yielded is
+    copied into Python.
     '''
-    with open(file_path, 'r', encoding='utf-8') as file:
-        memoir_text = file.read()
-    return memoir_text
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            yield from iter_chunks(view)
 
-# Define a function to chunk the memoir by chapters
-def chunk_by_chapter(text):
+def chapter_title(chapter):
     '''
-    Splits the memoir into chapters based on the format "Chapter X - Title".
+    Returns the heading line of a chapter, e.g. "Chapter 5 - Jones Beach Undertow",
+    or None for chunks that don't start with a chapter heading.
     '''
-    # Regular expression to match chapter headings like "Chapter 5 - Jones Beach Undertow !!!"
-    chapter_pattern = r"(Chapter \d+ - .+?)(?=\nChapter \d+ - |\Z)"
-    
-    # Find all chapters based on the pattern
-    chapters = re.findall(chapter_pattern, text, re.DOTALL)
+    heading = chapter.split('\n', 1)[0].strip()
+    return heading if re.match(r'Chapter \d+ - ', heading) else None
+
+def iter_chunks(text):
+    '''
+    Lazily splits a memoir into chunks: by chapter if it uses "Chapter X - Title"
+    headings, otherwise into runs of related sentences with semantic_chunk.
+    Accepts a str or a bytes-like buffer such as an mmap.
+    '''
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    if _CHAPTER_RE.search(text):
+        yield from iter_chapters(text)
+    else:
+        yield from semantic_chunk(bytes(text).decode('utf-8-sig').replace('\r\n', '\n'))
 
-    return chapters
+# Maximum size of chunks built from whole sentences when embeddings are
+# unavailable, roughly 500 tokens
+SIZE_CHUNK_CHARS = 2000
 
-def extract_keywords(text, seed=None):
+def semantic_chunk(text, k=3, pct=95):
+    '''
+    Splits text into chunks of related sentences. Each sentence is embedded
+    together with its neighbours (a window of `k` sentences), and a chunk
+    ends wherever the cosine distance to the next sentence's window reaches
+    the `pct` percentile of all such distances. Without embeddings, falls
+    back to size_chunk.
+    '''
+    pieces = _SENTENCE_RE.split(text.strip())
+    sentences = pieces[::2]
+    if len(sentences) < 2:
+        return [text.strip()] if text.strip() else []
+
+    half = k // 2
+    windows = [' '.join(sentences[max(0, i - half):i + half + 1]) for i in range(len(sentences))]
+    embeddings = embed_texts(windows)
+    if embeddings is None:
+        return size_chunk(pieces)
+
+    distances = 1 - np.sum(embeddings[:-1] * embeddings[1:], axis=1)
+    threshold = np.percentile(distances, pct)
+
+    # pieces alternates sentences and the whitespace after them, so sentence
+    # i is pieces[2 * i]
+    chunks = []
+    start = 0
+    for i, distance in enumerate(distances):
+        if distance >= threshold:
+            chunks.append(''.join(pieces[2 * start:2 * i + 1]))
+            start = i + 1
+    chunks.append(''.join(pieces[2 * start:]))
+    return chunks
+
+def size_chunk(pieces, max_chars=SIZE_CHUNK_CHARS):
+    '''
+    Groups consecutive sentences into chunks of up to `max_chars` characters,
+    keeping the original whitespace. `pieces` alternates sentences and the
+    whitespace after them, as produced by _SENTENCE_RE.split. A sentence
+    longer than `max_chars` becomes a chunk of its own.
+    '''
+    chunks = []
+    start = 0
+    size = 0
+    for i, sentence in enumerate(pieces[::2]):
+        if size and size + len(sentence) > max_chars:
+            chunks.append(''.join(pieces[2 * start:2 * i - 1]))
+            start = i
+            size = 0
+        size += len(sentence) + (len(pieces[2 * i + 1]) if 2 * i + 1 < len(pieces) else 0)
+    chunks.append(''.join(pieces[2 * start:]))
+    return chunks
+
+def iter_chapters(text):
+    '''
+    Lazily splits the memoir into chapters based on the format "Chapter X - Title".
+    Accepts a str or a bytes-like buffer such as an mmap.
+    '''
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    for match in _CHAPTER_RE.finditer(text):
+        yield _decode_chapter(match.group(1))
+
+# Common English words that carry no meaning for full-text search
+STOPWORDS = frozenset({
+    'a', 'about', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'did',
+    'do', 'does', 'for', 'from', 'had', 'has', 'have', 'he', 'her', 'him',
+    'his', 'how', 'i', 'in', 'is', 'it', 'me', 'my', 'of', 'on', 'or', 'she',
+    'tell', 'that', 'the', 'they', 'this', 'to', 'was', 'were', 'what',
+    'when', 'where', 'which', 'who', 'why', 'with', 'you',
+})
+
+# Runs of characters that can't appear in an FTS search term
+_SANITIZE_RE = re.compile(r'[^\w\s]+')
+
+def sanitize_for_match_query(text, prefix=False):
     """
-    Extracts search keywords from user input using the LLM.
+    Builds an FTS MATCH query from user input. Punctuation and stopwords
+    are dropped and the remaining words are OR'ed together, so bm25 ranks
+    chunks matching more of them higher. With `prefix`, words longer than
+    three letters become prefix terms and shorter ones are dropped.
     """
-    system = (
-        "You are a professional database query optimizer. "
-        "Given the text below, extract a list of relevant and concise keywords "
-        "that best represent the user's query. "
-        "Return the keywords separated by spaces. Do not include any other text."
-    )
-    keywords = run_llm(system, text, seed=seed).strip()
-    return keywords
+    words = _SANITIZE_RE.sub(' ', text).split()  # Remove non-alphanumeric chars
+    keywords = dict.fromkeys(word for word in words if word.lower() not in STOPWORDS)
+    if prefix:
+        terms = [f'"{keyword}"*' for keyword in keywords if len(keyword) > 3]
+    else:
+        terms = [f'"{keyword}"' for keyword in keywords]
+    return ' OR '.join(terms) or None
+
+# Maximum number of FTS candidates fetched per question, and per question
+# when the candidates are reranked
+SEARCH_LIMIT = 10
+RERANK_LIMIT = 50
 
-def sanitize_for_match_query(keywords):
+def fts_search(conn, match_query, memoir_id):
+    """
+    Returns (id, content) of the best matching chunks of a memoir, best first.
+    The MATCH runs first against the FTS index; only its hits are joined
+    back to filter by memoir. bm25() weighs title matches 10x and keyword
+    matches 3x over content matches; its scores are lower for better
+    matches, so order ascending.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        WITH matches AS (
+            SELECT rowid, bm25(memoir_chunks_fts, 10.0, 3.0, 1.0) AS score
+            FROM memoir_chunks_fts
+            WHERE memoir_chunks_fts MATCH ?
+        )
+        SELECT memoir_chunks.id, memoir_chunks.content
+        FROM matches
+        JOIN memoir_chunks ON memoir_chunks.id = matches.rowid
+        WHERE memoir_chunks.memoir_id = ?
+        ORDER BY matches.score
+        LIMIT ?
+    ''', (match_query, memoir_id, RERANK_LIMIT if reranker else SEARCH_LIMIT))
+    return cursor.fetchall()
+
+def dense_search(conn, user_input, memoir_id):
     """
-    Sanitizes extracted keywords for FTS MATCH queries.
+    Returns (id, content) of the chunks of a memoir closest in meaning to
+    the question, best first. Empty if embeddings are unavailable.
+    Embeddings are unit length, so a dot product is the cosine similarity.
     """
-    sanitized_keywords = re.sub(r'[^\w\s]', '', keywords)  # Remove non-alphanumeric chars
-    sanitized_keywords = ' '.join(sanitized_keywords.split())  # Normalize spaces
-    return f'"{sanitized_keywords}"' if sanitized_keywords else None
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, embedding
+        FROM memoir_chunks
+        WHERE memoir_id = ? AND embedding IS NOT NULL
+    ''', (memoir_id,))
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    query = embed_texts([user_input])
+    if query is None:
+        return []
+
+    embeddings = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.float32)
+    scores = embeddings.reshape(len(rows), -1) @ query[0]
+    limit = RERANK_LIMIT if reranker else SEARCH_LIMIT
+    chunk_ids = [rows[i][0] for i in np.argsort(-scores)[:limit]]
+
+    cursor.execute(f'''
+        SELECT id, content FROM memoir_chunks
+        WHERE id IN ({', '.join('?' * len(chunk_ids))})
+    ''', chunk_ids)
+    contents = dict(cursor.fetchall())
+    return [(chunk_id, contents[chunk_id]) for chunk_id in chunk_ids]
+
+def retrieve_chunks(conn, user_input, memoir_id):
+    """
+    Returns the memoir chunks most relevant to the question, best first,
+    or None if the question has no searchable keywords.
+    """
+    # Step 1: Build the FTS MATCH query from the question
+    sanitized_keywords = sanitize_for_match_query(user_input)
+    if not sanitized_keywords:
+        return None
 
-def search_across_chunks(conn, user_input, memoir_id, author, seed=None):
+    # Step 2: Perform FTS MATCH query, relaxing to prefix matches if the
+    # keywords alone find nothing
+    results = []
+    for match_query in (sanitized_keywords, sanitize_for_match_query(user_input, prefix=True)):
+        if not match_query:
+            continue
+        results = fts_search(conn, match_query, memoir_id)
+        if results:
+            break
+
+    # Step 3: Fuse the keyword matches with dense matches, if available;
+    # keep BM25 results alone if the dense search fails
+    try:
+        dense_results = dense_search(conn, user_input, memoir_id)
+    except Exception as e:
+        logging.error("Dense search error, using BM25 order: %s", e)
+        dense_results = []
+    contents = dict(results + dense_results)
+    ranking = rrf_fuse([chunk_id for chunk_id, _ in results],
+                       [chunk_id for chunk_id, _ in dense_results])
+    return rerank_chunks(user_input, [contents[chunk_id] for chunk_id in ranking])
+
+async def search_across_chunks(conn, user_input, memoir_id, author, seed=None):
     """
     Safety checks to classify user input before processing.
-    Extracts keywords and uses FTS match to return highest ranked chunk.
+    Uses the question's keywords in an FTS match to return highest ranked chunk.
+    The safety check runs concurrently with the search, so retrieval adds
+    no latency on top of Llama Guard.
     """
-    # Classify the user's input for safety using Llama Guard 3
-    is_safe, guard_response = classify_question_with_guard(user_input)
-    if not is_safe:
-        return f"Your question has been flagged as unsafe. Details: {guard_response}"
-    
-    # Step 1: Extract keywords
-    keywords = extract_keywords(user_input, seed=seed)
-    if not keywords:
-        return "I couldn't understand your query. Please try rephrasing."
+    # Classify the user's input for safety using Llama Guard 3. The call
+    # starts in a worker thread immediately; the search stays on this thread
+    # because sqlite3 connections are bound to the thread that created them.
+    guard = asyncio.get_running_loop().run_in_executor(
+        None, classify_question_with_guard, user_input)
 
-    # Step 2: Sanitize for FTS MATCH
-    sanitized_keywords = sanitize_for_match_query(keywords)
-    if not sanitized_keywords:
-        return "No valid keywords found. Please refine your question."
-
-    # Step 3: Perform FTS MATCH query
-    cursor = conn.cursor()
+    search_error = None
     try:
-        cursor.execute('''
-            SELECT content
-            FROM memoir_chunks_fts
-            WHERE memoir_id = ? AND content MATCH ?
-            ORDER BY rank DESC
-        ''', (memoir_id, sanitized_keywords))
-        results = cursor.fetchall()
+        chunks = retrieve_chunks(conn, user_input, memoir_id)
     except sqlite3.OperationalError as e:
-        logging.error(f"FTS MATCH query error: {e}")
-        return "An error occurred while searching the memoir."
+        logging.error("FTS MATCH query error: %s", e)
+        search_error = "An error occurred while searching the memoir."
+    except BaseException:
+        # Don't leave the guard future unobserved when the search fails
+        guard.cancel()
+        raise
+
+    # Discard the search results if the question is unsafe
+    is_safe, guard_response = await guard
+    if not is_safe:
+        return f"Your question has been flagged as unsafe. Details: {guard_response}"
 
-    if not results:
-        # Fallback: Provide the entire memoir if no matches
-        cursor.execute('''
-            SELECT content
-            FROM memoir_chunks
-            WHERE memoir_id = ?
-        ''', (memoir_id,))
-        full_memoir = " ".join(row[0] for row in cursor.fetchall())
-        user_prompt = f"Memoir text: {full_memoir}\n\nUser's question: {user_input}"
-        system = (
-            f"You are an assistant summarizing content from a memoir by {author}. "
-            "Answer the user's question based on the text provided. If you cannot find "
-            "specific information, respond with 'The memoir does not address this.'"
-        )
-        return run_llm(system, user_prompt, seed=seed)
+    if search_error:
+        return search_error
+    if chunks is None:
+        return "No valid keywords found. Please refine your question."
+    if not chunks:
+        # Nothing relevant in the memoir; don't send the whole memoir instead
+        return "The memoir does not address this."
 
     # Step 4: Use the highest-ranked chunk for the LLM
-    best_match = results[0][0]
+    best_match = chunks[0]
     system = (
         f"You are an assistant summarizing content from a memoir by {author}. "
         "Answer the user's question based on the text provided. If you cannot find "
         "specific information, respond with 'The memoir does not address this.'"
     )
     user_prompt = f"Memoir text: {best_match}\n\nUser's question: {user_input}"
-    return run_llm(system, user_prompt, seed=seed)
+    return await asyncio.to_thread(run_llm, system, user_prompt, seed=seed)
 
 def classify_question_with_guard(user_input):
     '''
     Classifies the user input for safety using Llama Guard 3.
+    Only safe verdicts are cached; unsafe ones are re-checked so their
+    details are always fresh.
     '''
+    key = _cache_key('llama-guard-3-8b', user_input)
+    if _cache_get(key) is not None:
+        return True, None
+
     completion = groq_client.chat.completions.create(
         model="llama-guard-3-8b",
         messages=[
@@ -306,22 +759,28 @@ def classify_question_with_guard(user_input):
     response = completion.choices[0].message.content
     if "unsafe" in response.lower():
         return False, response  # Unsafe detected, include category information
+    _cache_put(key, True)
     return True, None  # Safe
 
-def chat_with_memoir(user_input, memoir, author, seed=None):
+async def chat_with_memoir(conn, user_input, memoir_id, author, seed=None):
     '''
     Conduct a Q&A session with the memoir as context.
-    Uses Llama Guard 3 to classify questions before responding.
+    Uses Llama Guard 3 to classify questions before responding; the check
+    runs once, alongside the search, inside search_across_chunks.
     '''
-    # Classify the question for safety
-    is_safe, guard_response = classify_question_with_guard(user_input)
-    if not is_safe:
-        return f"Your question has been flagged as unsafe. Details: {guard_response}"
-    
-    # Proceed with memoir Q&A logic if the question is safe
-    chapters = chunk_by_chapter(memoir)
-    best_response = search_across_chunks(conn, user_input, memoir, author, seed=seed)
-    return best_response
+    return await search_across_chunks(conn, user_input, memoir_id, author, seed=seed)
+
+def generate_keywords(chapter_content):
+    """
+    Generates search keywords for a chapter, indexed alongside its content.
+    """
+    system = (
+        "You are a professional search indexer. "
+        "Given the memoir chapter below, list up to 15 concise keywords covering "
+        "its people, places, events and themes. "
+        "Return the keywords separated by spaces. Do not include any other text."
+    )
+    return run_llm(system, chapter_content).strip()
 
 def generate_system_prompt(author, chapter_content):
     """
@@ -353,24 +812,87 @@ def generate_image(prompt):
         'seed': 2414,
     }
 
+    partial_path = None
     try:
-        result = monster_client.generate(model, input_data)
-        image_urls = result['output']
-
         # Define the output folder relative to the current script location
         output_folder = os.path.join(os.path.dirname(__file__), 'gen_image')
         os.makedirs(output_folder, exist_ok=True)
 
-        image_path = os.path.join(output_folder, f'{hash(prompt)}.png')
-        image_data = requests.get(image_urls[0]).content
-        with open(image_path, 'wb') as image_file:
-            image_file.write(image_data)
-        
+        # Name images by a stable hash of the prompt so a prompt seen before
+        # (in this or an earlier run) reuses its image instead of calling Monster
+        key = hashlib.blake2b(prompt.encode('utf-8'), digest_size=16).hexdigest()
+        image_path = os.path.join(output_folder, f'{key}.png')
+        if os.path.exists(image_path):
+            return image_path
+
+        result = monster_client.generate(model, input_data)
+        image_urls = result['output']
+        # Stream the image to disk so it is never held in memory whole. Write
+        # to a uniquely named temporary file first so a failed download is not
+        # cached and concurrent downloads of the same prompt don't interleave.
+        with requests.get(image_urls[0], stream=True) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(dir=output_folder, suffix='.part', delete=False) as image_file:
+                partial_path = image_file.name
+                for chunk in response.iter_content(chunk_size=65536):
+                    image_file.write(chunk)
+        os.replace(partial_path, image_path)
+        partial_path = None
+
         print(f"Image saved at {image_path}")
         return image_path
     except Exception as e:
-        logging.error(f"Error generating image: {e}")
+        logging.error("Error generating image: %s", e)
         return None
+    finally:
+        if partial_path is not None and os.path.exists(partial_path):
+            os.remove(partial_path)
+
+async def generate_or_none(func, *args):
+    '''
+    Runs a blocking generation call in a worker thread, returning None if it
+    fails so one bad chapter doesn't sink the rest of its batch.
+    '''
+    try:
+        return await asyncio.to_thread(func, *args)
+    except Exception as e:
+        logging.error("Error in %s: %s", func.__name__, e)
+        return None
+
+async def generate_chapter_media(author, chapters, concurrency=8):
+    '''
+    Generates the keywords, system prompt and image for each chapter, with
+    up to `concurrency` chapters in flight at once. The Groq and Monster
+    clients are blocking, so each call runs in a worker thread.
+    Returns (keywords, system_prompt, image_path) tuples in chapter order.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(chapter):
+        async with semaphore:
+            keywords, system_prompt = await asyncio.gather(
+                generate_or_none(generate_keywords, chapter),
+                generate_or_none(generate_system_prompt, author, chapter),
+            )
+            image_path = None
+            if system_prompt:
+                image_path = await asyncio.to_thread(generate_image, system_prompt)
+            return keywords, system_prompt, image_path
+
+    return await asyncio.gather(*(process(chapter) for chapter in chapters))
+
+async def generate_keywords_for(contents, concurrency=8):
+    '''
+    Generates keywords for each chapter, with up to `concurrency` chapters
+    in flight at once. Returns the keywords (None on failure) in order.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(content):
+        async with semaphore:
+            return await generate_or_none(generate_keywords, content)
+
+    return await asyncio.gather(*(process(content) for content in contents))
 
 # Suppress HTTPX logs
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -384,21 +906,22 @@ if __name__ == '__main__':
     parser.add_argument('--title', type=str, help="Title of the memoir")
     parser.add_argument('--author', type=str, help="Author of the memoir")
     parser.add_argument('--content', type=str, help="Path to the text file of the memoir content (required for --save)")
+    parser.add_argument('--backfill-keywords', action='store_true', help="Generate search keywords for chunks saved without them")
     args = parser.parse_args()
     
     # Initialize the database connection
     conn = initialize_db()
-    add_system_prompt_column(conn)
-    add_image_path_column(conn)
 
-    if args.save:
+    if args.backfill_keywords:
+        backfill_keywords(conn)
+        print("Keywords generated for chunks that were missing them.")
+
+    elif args.save:
         # Saving a memoir to the database
         if not (args.title and args.author and args.content):
             print("To save a memoir, please provide --title, --author, and --content.")
         else:
-            with open(args.content, 'r') as file:
-                content = file.read()
-            save_memoir_to_db(conn, args.title, args.author, content)
+            save_memoir_to_db(conn, args.title, args.author, load_memoir(args.content))
             print(f"Memoir '{args.title}' by {args.author} has been saved to the database.")
     
     else:
@@ -425,7 +948,8 @@ if __name__ == '__main__':
                         break
                     
                     # Retrieve answer using search_across_chunks
-                    response = search_across_chunks(conn, user_input, memoir_id, args.author)
+                    response = asyncio.run(
+                        search_across_chunks(conn, user_input, memoir_id, args.author))
                     print("\nResponse:\n", response)
             else:
                 print(f"Memoir '{args.title}' by {args.author} not found in the database.")
@@ -1,48 +1,57 @@
+import asyncio
 import csv
-import sqlite3
 import logging
+import os
+import sqlite3
+import tempfile
 from memoir_rag import (
+    initialize_db,
     search_across_chunks,
     save_memoir_to_db,
-    add_image_path_column,  # Ensure you import this function
+    load_memoir,
 )
 
-def initialize_db(db_path='memoirs.db'):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Create memoirs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS memoirs (
-            id INTEGER PRIMARY KEY,
-            title TEXT,
-            author TEXT
-        )
-    ''')
-
-    # Create memoir chunks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS memoir_chunks (
-            id INTEGER PRIMARY KEY,
-            memoir_id INTEGER,
-            content TEXT,
-            system_prompt TEXT,
-            image_path TEXT,  -- Add the image_path column directly here
-            FOREIGN KEY (memoir_id) REFERENCES memoirs (id)
-        )
-    ''')
-
-    # Create an FTS table for fast full-text search
-    cursor.execute('''
-        CREATE VIRTUAL TABLE IF NOT EXISTS memoir_chunks_fts
-        USING fts5(content, chunk_id UNINDEXED, memoir_id UNINDEXED)
-    ''')
-
-    # Ensure image_path column is present
-    add_image_path_column(conn)
-
-    conn.commit()
-    return conn
+def check_initialize_db():
+    """
+    Checks that initialize_db sets up a new database and upgrades one
+    saved with the original schema, keeping the FTS index consistent.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # A new database
+        conn = initialize_db(os.path.join(tmp_dir, 'new.db'))
+        conn.execute("INSERT INTO memoir_chunks_fts (memoir_chunks_fts) VALUES ('integrity-check')")
+        conn.close()
+
+        # A database saved with the original schema
+        old_path = os.path.join(tmp_dir, 'old.db')
+        old = sqlite3.connect(old_path)
+        old.executescript('''
+            CREATE TABLE memoirs (id INTEGER PRIMARY KEY, title TEXT, author TEXT);
+            CREATE TABLE memoir_chunks (
+                id INTEGER PRIMARY KEY,
+                memoir_id INTEGER,
+                content TEXT,
+                system_prompt TEXT,
+                FOREIGN KEY (memoir_id) REFERENCES memoirs (id)
+            );
+            CREATE VIRTUAL TABLE memoir_chunks_fts
+            USING fts5(content, chunk_id UNINDEXED, memoir_id UNINDEXED);
+            INSERT INTO memoirs VALUES (1, 'alan test', 'alan plush');
+            INSERT INTO memoir_chunks (memoir_id, content)
+            VALUES (1, 'Chapter 16 - Grand Central Parkway ' || char(10) || 'It was late.'),
+                   (1, 'No heading here');
+        ''')
+        old.commit()
+        old.close()
+
+        conn = initialize_db(old_path)
+        titles = conn.execute('SELECT title FROM memoir_chunks ORDER BY id').fetchall()
+        assert titles == [('Chapter 16 - Grand Central Parkway',), (None,)], titles
+        conn.execute("INSERT INTO memoir_chunks_fts (memoir_chunks_fts) VALUES ('integrity-check')")
+        hits = conn.execute("SELECT rowid FROM memoir_chunks_fts WHERE memoir_chunks_fts MATCH 'title:parkway'").fetchall()
+        assert hits == [(1,)], hits
+        conn.close()
+    print("initialize_db: new and original-schema databases OK")
 
 def evaluate_test_questions(csv_path, db_path):
     """
@@ -51,14 +60,10 @@ def evaluate_test_questions(csv_path, db_path):
     # Initialize the database
     conn = initialize_db(db_path)
     
-    # Load the memoir content from file
-    with open("alan_test_doc.txt", "r", encoding="utf-8") as file:
-        test_memoir_content = file.read()
-
     # Save memoir to database (this now includes image path handling)
     title = "alan test"
     author = "alan plush"
-    save_memoir_to_db(conn, title, author, test_memoir_content)
+    save_memoir_to_db(conn, title, author, load_memoir("alan_test_doc.txt"))
 
     # Load test questions from CSV
     with open(csv_path, 'r') as csvfile:
@@ -77,7 +82,7 @@ def evaluate_test_questions(csv_path, db_path):
         memoir_id = 1  # Assuming we saved the memoir with ID 1
 
         # Get the response from the RAG system
-        response = search_across_chunks(conn, user_input, memoir_id, author)
+        response = asyncio.run(search_across_chunks(conn, user_input, memoir_id, author))
 
         # Scoring logic
         score = 0
@@ -113,4 +118,5 @@ if __name__ == "__main__":
     # Example usage
     test_csv_path = "test_questions.csv"
     database_path = "memoirs.db"
+    check_initialize_db()
     evaluate_test_questions(test_csv_path, database_path)
\ No newline at end of file